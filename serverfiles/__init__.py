@@ -79,41 +79,67 @@ Local files
 """
 
 import functools
-try:
-    import urllib.parse as urlparse
-except ImportError:
-    import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import urllib.parse as urlparse
 from contextlib import contextmanager
 import threading
+import weakref
+import io
 import os
 import tarfile
 import gzip
 import bz2
 import datetime
-import tempfile
 import json
 try:
-    from html.parser import HTMLParser
+    import orjson
 except ImportError:
-    from HTMLParser import HTMLParser
+    orjson = None
+import re
+from html import unescape as html_unescape
 import shutil
 
 import requests
 import requests.exceptions
 
-try:
-    FileNotFoundError
-except:
-    FileNotFoundError = IOError
-
 
 # default socket timeout in seconds
 TIMEOUT = 5
 
+# number of concurrent requests when querying many files on the server
+WORKERS = 32
+
+# buffer size in bytes for copying downloaded and decompressed data
+COPY_BUFSIZE = 1 << 20
+
+
+# use a faster JSON parser for info files if available
+if orjson is not None:
+
+    def _json_loads(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # json also accepts NaN, Infinity and integers over 64 bits
+            return json.loads(s)
+
+else:
+    _json_loads = json.loads
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_file_info(fname, mtime, size):
+    with open(fname, 'rb') as f:
+        return f.read()
+
 
 def _open_file_info(fname):
-    with open(fname, 'rt') as f:
-        return json.load(f)
+    # file contents are cached until their modification time or size change;
+    # on file systems with coarse timestamps, a rewrite of the same length
+    # within one timestamp tick is not noticed
+    st = os.stat(fname)
+    # parse on every call, so that each caller gets an independent dict
+    return _json_loads(_read_file_info(fname, st.st_mtime_ns, st.st_size))
 
 
 def _save_file_info(fname, info):
@@ -137,21 +163,117 @@ def _is_prefix(pref, whole):
     return True
 
 
-class _FindLinksParser(HTMLParser, object):
-
-    def __init__(self):
-        super(_FindLinksParser, self).__init__()
-        self.links = []
-
-    def handle_starttag(self, tag, attrs):
-        if tag == "a":
-            for name, value in attrs:
-                if name == "href":
-                    #ignore navidation and hidden files
-                    if value.startswith("?") or value.startswith("/") or \
-                       value.startswith(".") or value.startswith("__"):
-                        continue
-                    self.links.append(urlparse.unquote(value))
+# href values can be double-quoted, single-quoted or unquoted
+_LINK_RE = re.compile(br"""<a\s[^>]*?href\s*=\s*"""
+                      br"""(?:"([^"]*)"|'([^']*)'|([^\s>]+))""",
+                      re.IGNORECASE)
+
+
+def _find_links(content):
+    """Return links from a HTML directory index given as bytes."""
+    links = []
+    for groups in _LINK_RE.findall(content):
+        value = html_unescape(b"".join(groups).decode("utf-8"))
+        #ignore navidation and hidden files
+        if value.startswith("?") or value.startswith("/") or \
+           value.startswith(".") or value.startswith("__"):
+            continue
+        links.append(urlparse.unquote(value))
+    return links
+
+
+class _ResponseReader(io.RawIOBase):
+    """Readable raw stream over the contents of a streamed response."""
+
+    def __init__(self, req, callback=None):
+        self.req = req
+        self.callback = callback
+        self.size = req.headers.get('content-length')
+        if self.size:
+            self.size = int(self.size)
+        # the body is not decoded so that it matches content-length
+        self.chunks = req.raw.stream(COPY_BUFSIZE, decode_content=False)
+        self.chunk = memoryview(b"")
+        self.readb = 0
+        self.reported = 0  # percents reported to the callback
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            if self.finished:
+                return 0
+            try:
+                buf = next(self.chunks)
+            except StopIteration:
+                self._finish()
+                return 0
+            self.chunk = memoryview(buf)
+            self._progress(len(buf))
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def _progress(self, n):
+        self.readb += n
+        if self.size:
+            # the last percent is reported after completion
+            percent = min(self.readb * 100 // self.size, 99)
+            while self.reported < percent:
+                self.reported += 1
+                if self.callback:
+                    self.callback()
+
+    def _finish(self):
+        self.finished = True
+        # report the remaining percents (all of them if size was unknown)
+        while self.reported < 100:
+            self.reported += 1
+            if self.callback:
+                self.callback()
+
+    def close(self):
+        self.req.close()
+        super().close()
+
+
+def _save_stream(f, target):
+    """Copy a binary file object into a file named target."""
+    # write into a sibling file and rename it when done, so that
+    # an interrupted download never leaves a partial target
+    part = target + ".part"
+    try:
+        with open(part, "wb") as fo:
+            shutil.copyfileobj(f, fo, COPY_BUFSIZE)
+        os.replace(part, target)
+    except:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+def _extract_stream(f, target):
+    """Extract a tar archive from a binary file object into folder target."""
+    # extract into a sibling folder and rename it when done, so that
+    # an interrupted download never leaves a partial target
+    part = target + ".part"
+    if os.path.isdir(part):  # left over from a crashed process
+        shutil.rmtree(part)
+    try:
+        with tarfile.open(fileobj=f, mode="r|*") as tar:
+            os.mkdir(part)
+            tar.extractall(part)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+        os.replace(part, target)
+    except:
+        shutil.rmtree(part, ignore_errors=True)
+        raise
 
 
 class ServerFiles:
@@ -169,19 +291,23 @@ class ServerFiles:
         """Password for authenticated HTTP queried."""
 
         self.req = requests.Session()
-        a = requests.adapters.HTTPAdapter(max_retries=2)
+        a = requests.adapters.HTTPAdapter(max_retries=2,
+                                          pool_connections=WORKERS,
+                                          pool_maxsize=WORKERS)
         self.req.mount('https://', a)
         self.req.mount('http://', a)
 
         # cached info for all files on server
         # None is not loaded, False if it does not exist
         self._info = None
+        # searched texts for different search options
+        self._targets = {}
 
     def _download_server_info(self):
         if self._info is None:
             t = self._open("__INFO__")
             if t.status_code == 200:
-                self._info = {tuple(a): b for a, b in json.loads(t.text)}
+                self._info = {tuple(a): b for a, b in _json_loads(t.content)}
             else:
                 self._info = False #do not check again
 
@@ -191,18 +317,36 @@ class ServerFiles:
         self._download_server_info()
         if self._info:
             return [a for a in self._info.keys() if _is_prefix(args, a)]
-        text = self._open(*args).text
-        parser = _FindLinksParser()
-        parser.feed(text)
-        links = parser.links
+        if not recursive:
+            return self._listdir(*args)[0]
+
+        # list subfolders concurrently, but return files in the same
+        # (depth-first) order as a sequential traversal would
+        listings = {}
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            pending = {executor.submit(self._listdir, *args): args}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder = pending.pop(future)
+                    listings[folder] = future.result()
+                    for sub in listings[folder][1]:
+                        pending[executor.submit(self._listdir, *sub)] = sub
+
+        def collect(folder):
+            files, subfolders = listings[folder]
+            yield from files
+            for sub in subfolders:
+                yield from collect(sub)
+
+        return list(collect(args))
+
+    def _listdir(self, *args):
+        """Return a tuple of lists of files and subfolders in a folder."""
+        links = _find_links(self._open(*args).content)
         files = [args + (f,) for f in links if not f.endswith("/") and not f.endswith(".info")]
-        if recursive:
-            for f in links:
-                if f.endswith("/"):
-                    f = f.strip("/")
-                    nargs = args + (f,)
-                    files.extend([a for a in self.listfiles(*nargs, recursive=True)])
-        return files
+        folders = [args + (f.strip("/"),) for f in links if f.endswith("/")]
+        return files, folders
 
     def download(self, *path, **kwargs):
         """
@@ -213,52 +357,42 @@ class ServerFiles:
         target = kwargs.get("target", None)
         _create_path(os.path.dirname(target))
 
-        req = self._open(*path)
+        with self.stream(*path, callback=callback) as fdown:
+            _save_stream(fdown, target)
+
+    def stream(self, *path, **kwargs):
+        """
+        Return a binary file object for reading a file from the server.
+        Callback is called once for each read percentage.
+        """
+        callback = kwargs.get("callback", None)
+
+        # files are transferred as they are on the server, because
+        # compressed files may be served with a Content-Encoding
+        req = self._open(*path, headers={'Accept-Encoding': 'identity'})
         if req.status_code == 404:
             raise FileNotFoundError
         elif req.status_code != 200:
             raise IOError
 
-        size = req.headers.get('content-length')
-        if size:
-            size = int(size)
-
-        f = tempfile.TemporaryFile()
-
-        chunksize = 1024*8
-        lastchunkreport= 0.0001
-
-        readb = 0
-
-        for buf in req.iter_content(chunksize):
-            readb += len(buf)
-            while size and float(readb) / size > lastchunkreport+0.01:
-                lastchunkreport += 0.01
-                if callback:
-                    callback()
-            f.write(buf)
-
-        f.seek(0)
-
-        with open(target, "wb") as fo:
-            shutil.copyfileobj(f, fo)
-
-        if callback and not size: #size was unknown, call callbacks
-            for i in range(99):
-                callback()
-
-        if callback:
-            callback()
+        return io.BufferedReader(_ResponseReader(req, callback),
+                                 buffer_size=COPY_BUFSIZE)
 
     def allinfo(self, *path, **kwargs):
         """Return all info files in a dictionary, where keys are paths."""
         recursive = kwargs.get("recursive", True)
-        self._download_server_info()
         files = self.listfiles(*path, recursive=recursive)
-        infos = {}
-        for npath in files:
-            infos[npath] = self.info(*npath)
-        return infos
+        return dict(zip(files, self._infos(files)))
+
+    def _infos(self, files):
+        """Return a list of infos for a list of paths."""
+        # load __INFO__ once, before info is requested for every file
+        self._download_server_info()
+        if self._info:
+            return [self.info(*npath) for npath in files]
+        # otherwise request info files concurrently
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            return list(executor.map(lambda npath: self.info(*npath), files))
 
     def search(self, sstrings, **kwargs):
         """
@@ -271,7 +405,13 @@ class ServerFiles:
         """
         if self._info is None or self._info is False:
             self._info = self.allinfo()
-        return _search(self._info, sstrings, **kwargs)
+            self._targets = {}
+        # searched texts do not change, so prepare them only once
+        key = tuple(sorted(kwargs.items()))
+        if key not in self._targets:
+            self._targets[key] = _search_targets(self._info, **kwargs)
+        return _search_in(self._targets[key], sstrings,
+                          kwargs.get("case_sensitive", False))
 
     def info(self, *path):
         """Return a dictionary containing repository file info."""
@@ -282,29 +422,31 @@ class ServerFiles:
         path[-1] += ".info"
         t = self._open(*path)
         if t.status_code == 200:
-            return json.loads(t.text)
+            return _json_loads(t.content)
         else:
             return {}
 
-    def _server_request(self, root, *path):
+    def _server_request(self, root, *path, **kwargs):
         auth = None
         if self.username and self.password:
             auth = (self.username, self.password)
         return self.req.get(root + "/".join(path), auth=auth,
-                            timeout=TIMEOUT, stream=True)
+                            timeout=TIMEOUT, stream=True, **kwargs)
 
-    def _open(self, *args):
-        return self._server_request(self.server, *args)
+    def _open(self, *args, **kwargs):
+        return self._server_request(self.server, *args, **kwargs)
 
 
 def _keyed_lock(lock_constructor=threading.Lock):
     lock = threading.Lock()
-    locks = {}
+    # a lock is forgotten once nobody references it
+    locks = weakref.WeakValueDictionary()
     def get_lock(key):
         with lock:
-            if key not in locks:
-                locks[key] = lock_constructor()
-            return locks[key]
+            klock = locks.get(key)
+            if klock is None:
+                klock = locks[key] = lock_constructor()
+            return klock
     return get_lock
 
 
@@ -312,16 +454,6 @@ def _keyed_lock(lock_constructor=threading.Lock):
 _get_lock = _keyed_lock(threading.RLock)
 
 
-def _split_path(head):
-    out = []
-    while True:
-        head, tail = os.path.split(head)
-        out.insert(0, tail)
-        if not head:
-            break
-    return out
-
-
 class LocalFiles:
     """Manage local files."""
 
@@ -329,13 +461,15 @@ class LocalFiles:
         self.serverfiles_dir = path
         """A folder downloaded files are stored in."""
         _create_path(self.serverfiles_dir)
+        # resolved once, so that file operations need no extra lookups
+        self._root = os.path.normpath(os.path.realpath(
+            os.path.expanduser(self.serverfiles_dir)))
         self.serverfiles = serverfiles
         """A ServerFiles instance."""
 
     @contextmanager
     def _lock_file(self, *args):
-        path = self.localpath(*args)
-        path = os.path.normpath(os.path.realpath(path))
+        path = os.path.normpath(self.localpath(*args))
         lock = _get_lock(path)
         lock.acquire(True)
         try:
@@ -353,42 +487,51 @@ class LocalFiles:
 
     def localpath(self, *args):
         """ Return the local location for a file. """
-        return os.path.join(os.path.expanduser(self.serverfiles_dir), *args)
+        return os.path.join(self._root, *args)
 
     @_locked
     def download(self, *path, **kwargs):
         """Download file from the repository. Callback can be a function without
         arguments and will be called once for each downloaded percent of
         file: 100 times for the whole file. If extract is True, files
-        marked as compressed will be uncompressed after download."""
+        marked as compressed will be uncompressed after download.
+        Server info for the file can be passed as info if already known."""
         extract = kwargs.get("extract", True)
         callback = kwargs.get("callback", None)
-        info = self.serverfiles.info(*path)
+        info = kwargs.get("info", None)
+        if info is None:
+            # request the info and the file concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                finfo = executor.submit(self.serverfiles.info, *path)
+                fdown = self.serverfiles.stream(*path, callback=callback)
+                try:
+                    info = finfo.result()
+                except:
+                    fdown.close()
+                    raise
+        else:
+            fdown = self.serverfiles.stream(*path, callback=callback)
 
-        extract = extract and "compression" in info
+        compression = info.get("compression")
+        extract = extract and compression in ["tar.gz", "tar.bz2", "gz", "bz2"]
         target = self.localpath(*path)
-        self.serverfiles.download(*path,
-                                  target=target + ".tmp" if extract else target,
-                                  callback=callback)
+        _create_path(os.path.dirname(target))
 
-        _save_file_info(target + '.info', info)
+        with fdown:
+            if not extract:
+                _save_stream(fdown, target)
+            # decompress while downloading, without an intermediate file
+            elif compression in ["tar.gz", "tar.bz2"]:
+                _extract_stream(fdown, target)
+            else:
+                opener = gzip.open if compression == "gz" else bz2.open
+                with opener(fdown, "rb") as f:
+                    _save_stream(f, target)
+            # read any trailing data to complete progress reports
+            while fdown.read(COPY_BUFSIZE):
+                pass
 
-        if extract:
-            if info.get("compression") in ["tar.gz", "tar.bz2"]:
-                f = tarfile.open(target + ".tmp")
-                try:
-                    os.mkdir(target)
-                except OSError:
-                    pass
-                f.extractall(target)
-            elif info.get("compression") == "gz":
-                f = gzip.open(target + ".tmp")
-                shutil.copyfileobj(f, open(target, "wb"))
-            elif info.get("compression") == "bz2":
-                f = bz2.BZ2File(target + ".tmp", "r")
-                shutil.copyfileobj(f, open(target, "wb"))
-            f.close()
-            os.remove(target + ".tmp")
+        _save_file_info(target + '.info', info)
 
     @_locked
     def localpath_download(self, *path, **kwargs):
@@ -404,19 +547,23 @@ class LocalFiles:
     def listfiles(self, *path):
         """List files (or folders) in local repository that have
         corresponding .info files.  Do not list .info files."""
-        dir = self.localpath(*path)
         files = []
-        for root, dirs, fnms in os.walk(dir):
-            for f in fnms:
-                if f[-5:] == '.info' and os.path.exists(os.path.join(root, f[:-5])):
-                    try:
-                        _open_file_info(os.path.join(root, f))
-                        files.append(
-                            path + tuple(_split_path(
-                                os.path.relpath(os.path.join(root, f[:-5]), start=dir)
-                            )))
-                    except ValueError:
-                        pass
+
+        def walk(dir, path):
+            try:
+                with os.scandir(dir) as it:
+                    entries = list(it)
+            except OSError:
+                return
+            names = set(e.name for e in entries)
+            for e in entries:
+                if e.name[-5:] == '.info' and e.name[:-5] in names:
+                    files.append(path + (e.name[:-5],))
+            for e in entries:
+                if e.is_dir(follow_symlinks=False):
+                    walk(e.path, path + (e.name,))
+
+        walk(self.localpath(*path), path)
         return files
 
     def info(self, *path):
@@ -429,31 +576,45 @@ class LocalFiles:
         files = self.listfiles(*path)
         dic = {}
         for filename in files:
-            dic[filename] = self.info(*filename)
+            try:
+                dic[filename] = self.info(*filename)
+            except ValueError:  # skip broken info files
+                pass
         return dic
 
     def needs_update(self, *path):
         """Return True if a file does not exist in the local repository,
         if there is a newer version on the server or if either
         version can not be determined."""
+        return self._needs_update(path)[0]
+
+    def _needs_update(self, path, sinfo=None):
+        """Return whether a file needs an update and its server info,
+        which is None if it was not needed. Server info is only
+        retrieved if not given."""
         dt_fmt = "%Y-%m-%d %H:%M:%S"
         try:
             linfo = self.info(*path)
             dt_local = datetime.datetime.strptime(
                             linfo["datetime"][:19], dt_fmt)
+            if sinfo is None:
+                sinfo = self.serverfiles.info(*path)
             dt_server = datetime.datetime.strptime(
-                self.serverfiles.info(*path)["datetime"][:19], dt_fmt)
-            return dt_server > dt_local
+                sinfo["datetime"][:19], dt_fmt)
+            return dt_server > dt_local, sinfo
         except FileNotFoundError:
-            return True
-        except KeyError:
-            return True
+            return True, sinfo
+        except (KeyError, ValueError):
+            return True, sinfo
 
     def update(self, *path, **kwargs):
         """Download the corresponding file from the server if server
-        copy was updated.
+        copy was updated. Server info for the file can be passed as
+        info if already known.
         """
-        if self.needs_update(*path):
+        needs, info = self._needs_update(path, kwargs.get("info", None))
+        if needs:
+            kwargs["info"] = info
             self.download(*path, **kwargs)
 
     def search(self, sstrings, **kwargs):
@@ -465,8 +626,11 @@ class LocalFiles:
         return _search(si, sstrings, **kwargs)
 
     def update_all(self, *path):
-        for fu in self.listfiles(*path):
-            self.update(*fu)
+        files = self.listfiles(*path)
+        # retrieve server info for all files at once
+        infos = self.serverfiles._infos(files)
+        for fu, info in zip(files, infos):
+            self.update(*fu, info=info)
 
     @_locked
     def remove(self, *path):
@@ -485,28 +649,29 @@ class LocalFiles:
             raise FileNotFoundError
 
 
-def _search(si, sstrings, case_sensitive=False, in_tag=True, in_title=True, in_name=True):
-    found = []
-
+def _search_targets(si, case_sensitive=False, in_tag=True, in_title=True, in_name=True):
+    """Return a list of (path, searched text) for all files."""
+    targets = []
     for path, info in si.items():
         target = ""
         if in_tag: target += " ".join(info.get('tags', []))
         if in_title: target += info.get('title', "")
         if in_name: target += " ".join(path)
         if not case_sensitive: target = target.lower()
+        targets.append((path, target))
+    return targets
+
 
-        match = True
-        for s in sstrings:
-            if not case_sensitive:
-                s = s.lower()
-            if s not in target:
-                match = False
-                break
+def _search_in(targets, sstrings, case_sensitive=False):
+    if not case_sensitive:
+        sstrings = [s.lower() for s in sstrings]
+    return [path for path, target in targets
+            if all(s in target for s in sstrings)]
 
-        if match:
-            found.append(path)
 
-    return found
+def _search(si, sstrings, **kwargs):
+    return _search_in(_search_targets(si, **kwargs), sstrings,
+                      kwargs.get("case_sensitive", False))
 
 
 def sizeformat(size):
@@ -13,6 +13,7 @@ if __name__ == '__main__':
         install_requires=[
             'requests>=2.11.1',
         ],
+        python_requires='>=3.6',
         version='0.3.0',
         zip_safe=False,
         url="https://github.com/biolab/serverfiles",
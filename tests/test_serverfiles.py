@@ -5,25 +5,21 @@ import unittest
 import multiprocessing
 import os
 import shutil
-try:
-    from http.server import HTTPServer, SimpleHTTPRequestHandler
-except ImportError:
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-    from BaseHTTPServer import HTTPServer
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import tempfile
 import gzip
 import bz2
 import tarfile
 import sys
 import time
+import json
+import gc
+import io
+import threading
+import weakref
 
 import serverfiles
 
-try:
-    FileNotFoundError
-except:
-    FileNotFoundError = IOError
-
 
 DATETIMETEST = "2013-07-03 11:39:07.381031"
 
@@ -33,6 +29,31 @@ def create(name, contents):
         f.write(contents)
 
 
+class GzipEncodingHandler(SimpleHTTPRequestHandler):
+    """Label the gz file as gzip-encoded, as some servers do."""
+
+    def end_headers(self):
+        if self.path == "/comp/gz":
+            self.send_header("Content-Encoding", "gzip")
+        super().end_headers()
+
+
+class InterruptedStream(io.RawIOBase):
+    """Return the given data, then fail as if the connection dropped."""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.data.readinto(b)
+        if not n:
+            raise IOError("connection dropped")
+        return n
+
+
 def server(path, info):
     os.chdir(path)
 
@@ -47,8 +68,8 @@ def server(path, info):
     with gzip.open(os.path.join("comp", "gz"), "wt") as f:
         f.write("compress")
     create(("comp", "gz.info"), '{"compression": "gz"}')
-    with bz2.BZ2File(os.path.join("comp", "bz2"), "w") as f: #Python 2.7 compatibility
-        f.write("compress".encode("ascii"))
+    with bz2.open(os.path.join("comp", "bz2"), "wt") as f:
+        f.write("compress")
     create(("comp", "bz2.info"), '{"compression": "bz2"}')
     create(("intar",), "compress")
     with tarfile.open(os.path.join("comp", "tar.gz"), "w") as tar:
@@ -66,7 +87,7 @@ def server(path, info):
     # http server outputs a line for every connection
     sys.stderr = open(os.devnull, "w")
 
-    httpd = HTTPServer(("", 12345),  SimpleHTTPRequestHandler)
+    httpd = HTTPServer(("", 12345),  GzipEncodingHandler)
     httpd.serve_forever()
 
 
@@ -107,6 +128,9 @@ class TestServerFiles(unittest.TestCase):
         cb = CB()
         self.lf.download("domain1", "withinfo", callback=cb)
         self.assertEqual(cb.run, 100)
+        cb = CB()
+        self.lf.download("comp", "tar.gz", callback=cb)
+        self.assertEqual(cb.run, 100)
 
     def test_listdir_server(self):
         ldomain = self.sf.listfiles("domain1")
@@ -127,6 +151,12 @@ class TestServerFiles(unittest.TestCase):
         slist = self.sf.listfiles("domain1")
         self.assertEqual(set(llist), set(slist))
 
+    def test_download_missing(self):
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.lf.download("domain1", "missing"))
+        self.assertFalse(os.path.exists(self.lf.localpath("domain1", "missing")))
+        self.assertFalse(os.path.exists(self.lf.localpath("domain1", "missing.info")))
+
     def test_compressed(self):
         self.lf.download("comp", "gz")
         self.lf.download("comp", "bz2")
@@ -142,10 +172,31 @@ class TestServerFiles(unittest.TestCase):
         self.assertTrue(os.path.isdir(self.lf.localpath("comp", "tar.gz")))
         self.assertEqual(read(self.lf.localpath("comp", "tar.gz", "intar")),
                          read(self.lf.localpath("comp", "bz2")))
+        self.assertEqual(sorted(os.listdir(self.lf.localpath("comp"))),
+                         ["bz2", "bz2.info", "gz", "gz.info", "tar.gz", "tar.gz.info"])
         self.lf.remove("comp", "tar.gz")
         self.assertFalse(os.path.exists(self.lf.localpath("comp", "tar.gz")))
         self.assertFalse(os.path.exists(self.lf.localpath("comp", "tar.gz.info")))
 
+    def test_download_content_encoded(self):
+        target = os.path.join(self.path, "gz")
+        self.sf.download("comp", "gz", target=target)
+        with open(target, "rb") as f, \
+                open(os.path.join(self.pathserver, "comp", "gz"), "rb") as fs:
+            self.assertEqual(f.read(), fs.read())
+
+    def test_download_interrupted(self):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w") as tar:
+            member = tarfile.TarInfo("big")
+            member.size = 100000
+            tar.addfile(member, io.BytesIO(b"x" * member.size))
+        data = archive.getvalue()[:70000]
+        self.sf.stream = lambda *path, **kwargs: InterruptedStream(data)
+        self.assertRaises(IOError, lambda: self.lf.download("comp", "tar.gz"))
+        self.assertEqual(os.listdir(self.path), ["comp"])
+        self.assertEqual(os.listdir(self.lf.localpath("comp")), [])
+
     def test_info(self):
         self.lf.download("domain1", "withinfo")
         self.lf.download("domain1", "withoutinfo")
@@ -157,6 +208,31 @@ class TestServerFiles(unittest.TestCase):
                          DATETIMETEST)
         self.assertEqual(self.sf.allinfo("domain1"), self.lf.allinfo("domain1"))
 
+    def test_info_changed(self):
+        self.lf.download("domain1", "withinfo")
+        info = self.lf.info("domain1", "withinfo")
+        info["tags"] = ["changed"]
+        self.assertNotEqual(self.lf.info("domain1", "withinfo"), info)
+        serverfiles._save_file_info(
+            self.lf.localpath("domain1", "withinfo.info"), info)
+        self.assertEqual(self.lf.info("domain1", "withinfo"), info)
+
+    def test_info_nested_change(self):
+        self.lf.download("domain1", "withinfo")
+        info = self.lf.info("domain1", "withinfo")
+        info["tags"] = ["a"]
+        serverfiles._save_file_info(
+            self.lf.localpath("domain1", "withinfo.info"), info)
+        self.lf.info("domain1", "withinfo")["tags"].append("b")
+        self.assertEqual(self.lf.info("domain1", "withinfo")["tags"], ["a"])
+
+    def test_broken_info(self):
+        self.lf.download("domain1", "withinfo")
+        self.lf.download("domain1", "withoutinfo")
+        create((self.path, "domain1", "withoutinfo.info"), "{broken")
+        self.assertEqual(list(self.lf.allinfo()), [("domain1", "withinfo")])
+        self.assertTrue(self.lf.needs_update("domain1", "withoutinfo"))
+
     def test_remove(self):
         lpath = self.lf.localpath_download("domain1", "withoutinfo")
         self.assertTrue(os.path.exists(lpath))
@@ -176,6 +252,19 @@ class TestServerFiles(unittest.TestCase):
         self.assertTrue(self.lf.needs_update("domain1", "withoutinfo"))
         self.lf.update_all()
 
+    def test_update_all_loads_server_info_once(self):
+        self.lf.download("domain1", "withinfo")
+        self.lf.download("domain1", "withoutinfo")
+        self.lf.download("comp", "gz")
+        sf = serverfiles.ServerFiles(server="http://localhost:12345/")
+        opened = []
+        def _open(*args, **kwargs):
+            opened.append(args)
+            return serverfiles.ServerFiles._open(sf, *args, **kwargs)
+        sf._open = _open
+        serverfiles.LocalFiles(path=self.path, serverfiles=sf).update_all()
+        self.assertEqual(opened.count(("__INFO__",)), 1)
+
     def test_search(self):
         self.lf.download("domain1", "withinfo")
         self.lf.download("domain1", "withoutinfo")
@@ -185,6 +274,54 @@ class TestServerFiles(unittest.TestCase):
         self.assertEqual(self.sf.search("search"), [("domain1", "withinfo")])
 
 
+class TestInfoFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_save_open(self):
+        fname = os.path.join(self.path, "file.info")
+        info = {"tags": ["a", "ž"], "size": 2 ** 70, "ratio": float("inf")}
+        serverfiles._save_file_info(fname, info)
+        self.assertEqual(serverfiles._open_file_info(fname), info)
+
+    def test_parsers_agree(self):
+        for s in [b'{"tags": ["a"], "datetime": "2013-07-03 11:39:07"}',
+                  b'{"size": 1180591620717411303424}',
+                  b'{"ratio": Infinity}']:
+            self.assertEqual(serverfiles._json_loads(s), json.loads(s))
+        self.assertRaises(ValueError, serverfiles._json_loads, b"{broken")
+
+
+class TestFindLinks(unittest.TestCase):
+
+    def test_quoting(self):
+        content = b"""<a href="?C=M;O=A">Name</a>
+<a href="../">Parent</a>
+<a href="it's-data.txt">it's-data.txt</a>
+<a href='double"quote'>x</a>
+<a href=plain.txt>plain.txt</a>
+<A class="file" HREF="a%20b&amp;c/">a b&amp;c/</A>"""
+        self.assertEqual(serverfiles._find_links(content),
+                         ["it's-data.txt", 'double"quote', "plain.txt", "a b&c/"])
+
+
+class TestKeyedLock(unittest.TestCase):
+
+    def test_released_locks_are_forgotten(self):
+        get_lock = serverfiles._keyed_lock(threading.RLock)
+        lock = get_lock("a")
+        self.assertIs(get_lock("a"), lock)
+        self.assertIsNot(get_lock("b"), lock)
+        ref = weakref.ref(lock)
+        del lock
+        gc.collect()
+        self.assertIsNone(ref())
+
+
 class TestServerFilesInfo(TestServerFiles):
     """ Repeats the same tests with __INFO__ file. """
 